@@ -1,14 +1,55 @@
 import asyncio
-import json
-from functools import partial
+import ssl
+import time
 
 import aiohttp
-import requests
+import orjson
 import websockets
 
 from .handler import RaceHandler
 
 
+class RaceEntry:
+    """
+    Everything the bot keeps track of for a single race.
+
+    * summary - Race summary, as listed by the category data API endpoint.
+    * data - Race data, as retrieved from the race detail API endpoint. This
+      is discarded whenever the race summary changes.
+    * task - The handler task for this race, while it is running.
+    * state - The stateful data dict for this race, given to its handler.
+    """
+    __slots__ = ('summary', 'data', 'task', 'state')
+
+    def __init__(self, summary):
+        self.summary = summary
+        self.data = None
+        self.task = None
+        self.state = {}
+
+
+class RaceConnection:
+    """
+    WebSocket connection to a race room, for use with `async with`.
+
+    Each time it is entered, a new connection is opened with the bot's
+    current access token, so reconnecting never reuses an expired token.
+    """
+    __slots__ = ('bot', 'websocket_url', '_conn')
+
+    def __init__(self, bot, websocket_url):
+        self.bot = bot
+        self.websocket_url = websocket_url
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self.bot.connect(self.websocket_url)
+        return await self._conn.__aenter__()
+
+    async def __aexit__(self, *exc_info):
+        return await self._conn.__aexit__(*exc_info)
+
+
 class Bot:
     """
     The racetime.gg bot class.
@@ -24,7 +65,18 @@ class Bot:
     racetime_host = 'racetime.gg'
     racetime_secure = True
     scan_races_every = 30
+    # While the race list isn't changing, the scan interval backs off from
+    # `scan_races_every` up to this many seconds.
+    scan_races_max = 120
     reauthorize_every = 36000
+    # Seconds before expiry at which the access token is considered stale.
+    reauthorize_margin = 600
+    # Maximum number of race detail requests in flight at once.
+    max_concurrent_requests = 16
+    # Compression used on race room websockets. 'deflate' compresses every
+    # frame, which mostly pays off on large race data updates. Set to None to
+    # save the CPU cost when the bot mostly exchanges small messages.
+    websocket_compression = 'deflate'
 
     continue_on = [
         # Exception types that will not cause the bot to shut down.
@@ -43,14 +95,44 @@ class Bot:
         self.ssl_context = ssl_context
 
         self.loop = asyncio.get_event_loop()
+        self.session = None
         self.last_scan = None
-        self.handlers = {}
         self.races = {}
-        self.state = {}
+        self._data_etag = None
+        self._race_list = []
+        self._data_last_modified = None
+        self._scan_interval = self.scan_races_every
 
         self.client_id = client_id
         self.client_secret = client_secret
-        self.access_token, self.reauthorize_every = self.authorize()
+        self.access_token = None
+        self._token_expires_at = None
+        self._token_lock = None
+
+    async def start(self):
+        """
+        Prepare the bot for running. Opens the HTTP session shared by all
+        API requests and retrieves the initial access token.
+        """
+        if self.ssl_context is None and self.racetime_secure:
+            # Share one SSL context between all race room connections, rather
+            # than having each connection build and load its own.
+            self.ssl_context = ssl.create_default_context()
+        # Every request goes to the same host, so keep connections (and DNS
+        # lookups) around between scans rather than setting them up again.
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=32,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+                ssl=self.ssl_context or True,
+            ),
+            raise_for_status=True,
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+        self._token_lock = asyncio.Lock()
+        await self.get_access_token()
 
     def get_handler_class(self):
         """
@@ -84,30 +166,53 @@ class Bot:
         status = race_data.get('status', {}).get('value')
         return status not in self.get_handler_class().stop_at
 
-    def authorize(self):
+    async def authorize(self):
         """
         Get an OAuth2 token from the authentication server.
         """
-        resp = requests.post(self.http_uri('/o/token'), {
+        async with self.session.post(self.http_uri('/o/token'), data={
             'client_id': self.client_id,
             'client_secret': self.client_secret,
             'grant_type': 'client_credentials',
-        })
-        resp.raise_for_status()
-        data = json.loads(resp.content)
+        }) as resp:
+            data = await resp.json(loads=orjson.loads, content_type=None)
         if not data.get('access_token'):
             raise Exception('Unable to retrieve access token.')
         return data.get('access_token'), data.get('expires_in', 36000)
 
-    def create_handler(self, race_data):
+    async def get_access_token(self):
         """
-        Create a new WebSocket connection and set up a handler object to manage
-        it.
+        Return a usable access token, only requesting a new one from the
+        authentication server if the current token is missing or about to
+        expire.
+
+        Concurrent callers share a single token request.
+        """
+        async with self._token_lock:
+            if (
+                self.access_token is None
+                or time.monotonic() >= self._token_expires_at
+            ):
+                self.access_token, self.reauthorize_every = await self.authorize()
+                self._token_expires_at = time.monotonic() + max(
+                    self.reauthorize_every - self.reauthorize_margin,
+                    self.reauthorize_every / 2,
+                )
+        return self.access_token
+
+    async def connect(self, websocket_url):
+        """
+        Returns a new WebSocket connection to the given race room URL, ready
+        to be opened with `async with`.
+
+        The current access token is fetched (refreshing it if needed) each
+        time this is called, so reconnects never reuse an expired token.
         """
         connect_kwargs = {
             'additional_headers': {
-                'Authorization': 'Bearer ' + self.access_token,
+                'Authorization': 'Bearer ' + await self.get_access_token(),
             },
+            'compression': self.websocket_compression,
         }
 
         # BC for websockets<14
@@ -120,25 +225,26 @@ class Bot:
 
         if self.ssl_context is not None and self.racetime_secure:
             connect_kwargs['ssl'] = self.ssl_context
-        ws_conn = websockets.connect(
-            self.ws_uri(race_data.get('websocket_bot_url')),
-            **connect_kwargs,
-        )
+        return websockets.connect(self.ws_uri(websocket_url), **connect_kwargs)
+
+    def create_handler(self, race_data):
+        """
+        Set up a handler object to manage a race room. The handler opens its
+        own WebSocket connection when run.
+        """
+        ws_conn = RaceConnection(self, race_data.get('websocket_bot_url'))
 
         race_name = race_data.get('name')
-        if race_name not in self.state:
-            self.state[race_name] = {}
+        if race_name not in self.races:
+            self.races[race_name] = RaceEntry({})
 
         cls = self.get_handler_class()
-        kwargs = self.get_handler_kwargs(ws_conn, self.state[race_name])
+        kwargs = self.get_handler_kwargs(ws_conn, self.races[race_name].state)
 
         handler = cls(**kwargs)
         handler.data = race_data
 
-        self.logger.info(
-            'Created handler for %(race)s'
-            % {'race': race_data.get('name')}
-        )
+        self.logger.info('Created handler for %s', race_data.get('name'))
 
         return handler
 
@@ -147,15 +253,13 @@ class Bot:
         Reauthorize with the token endpoint, to generate a new access token
         before the current one expires.
 
-        This method runs in a constant loop, creating a new access token when
-        needed.
+        This method runs in a constant loop, sleeping until the current token
+        is due to be replaced.
         """
         while True:
-            # Divide the reauthorization interval by 2 to avoid token expiration
-            delay = self.reauthorize_every / 2
-            await asyncio.sleep(delay)
+            await asyncio.sleep(max(self._token_expires_at - time.monotonic(), 0))
             self.logger.info('Get new access token')
-            self.access_token, self.reauthorize_every = self.authorize()
+            await self.get_access_token()
 
     async def refresh_races(self):
         """
@@ -164,54 +268,114 @@ class Bot:
         for any race that should be handled but currently isn't.
 
         This method runs in a constant loop, checking for new races every few
-        seconds.
+        seconds. Scans slow down while nothing changes, and return to
+        `scan_races_every` as soon as something does.
         """
-        def done(task_name, *args):
-            del self.handlers[task_name]
-
         while True:
+            changed = False
             self.logger.info('Refresh races')
+            # Only ask for the race list if it has changed since last time.
+            headers = {}
+            if self._data_etag:
+                headers['If-None-Match'] = self._data_etag
+            if self._data_last_modified:
+                headers['If-Modified-Since'] = self._data_last_modified
             try:
-                async with aiohttp.request(
-                    method='get',
-                    url=self.http_uri(f'/{self.category_slug}/data'),
-                    raise_for_status=True,
+                async with self.session.get(
+                    self.http_uri(f'/{self.category_slug}/data'),
+                    headers=headers,
                 ) as resp:
-                    data = json.loads(await resp.read())
+                    if resp.status != 304:
+                        data = await resp.json(loads=orjson.loads, content_type=None)
+                        self._race_list = data.get('current_races', [])
+                        self._data_etag = resp.headers.get('ETag')
+                        self._data_last_modified = resp.headers.get('Last-Modified')
             except Exception:
                 self.logger.error('Fatal error when attempting to retrieve race data.', exc_info=True)
                 await asyncio.sleep(self.scan_races_every)
                 continue
-            self.races = {}
-            for race in data.get('current_races', []):
-                self.races[race.get('name')] = race
-
-            for name, summary_data in self.races.items():
-                if name not in self.handlers:
-                    try:
-                        async with aiohttp.request(
-                            method='get',
-                            url=self.http_uri(summary_data.get('data_url')),
-                            raise_for_status=True,
-                        ) as resp:
-                            race_data = json.loads(await resp.read())
-                    except Exception:
-                        self.logger.error('Fatal error when attempting to retrieve summary data.', exc_info=True)
-                        await asyncio.sleep(self.scan_races_every)
-                        continue
-                    if self.should_handle(race_data):
-                        handler = self.create_handler(race_data)
-                        self.handlers[name] = self.loop.create_task(handler.handle())
-                        self.handlers[name].add_done_callback(partial(done, name))
-                    else:
-                        if name in self.state:
-                            del self.state[name]
-                        self.logger.info(
-                            'Ignoring %(race)s by configuration.'
-                            % {'race': race_data.get('name')}
-                        )
-
-            await asyncio.sleep(self.scan_races_every)
+
+            # Keep entries for races that are still current (or still being
+            # handled), and discard race data whose summary has changed. This
+            # runs against the last listing even when it came back unchanged,
+            # so finished races are still pruned.
+            races = {
+                name: entry for name, entry in self.races.items()
+                if entry.task
+            }
+            for summary_data in self._race_list:
+                name = summary_data.get('name')
+                entry = self.races.get(name)
+                if entry is None:
+                    entry = RaceEntry(summary_data)
+                    changed = True
+                elif entry.summary != summary_data:
+                    entry.summary = summary_data
+                    entry.data = None
+                    changed = True
+                races[name] = entry
+            if races.keys() != self.races.keys():
+                changed = True
+            self.races = races
+
+            # Fetch race data for every unhandled race concurrently.
+            semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+            entries = [entry for entry in self.races.values() if not entry.task]
+            results = await asyncio.gather(*(
+                self._fetch_race_data(entry, semaphore) for entry in entries
+            ), return_exceptions=True)
+
+            for entry, race_data in zip(entries, results):
+                if isinstance(race_data, Exception):
+                    self.logger.error(
+                        'Fatal error when attempting to retrieve summary data.',
+                        exc_info=race_data,
+                    )
+                    continue
+                if self.should_handle(race_data):
+                    changed = True
+                    handler = self.create_handler(race_data)
+                    entry.task = self.loop.create_task(handler.handle())
+                    entry.task.add_done_callback(
+                        lambda task, entry=entry: self._handler_done(entry)
+                    )
+                else:
+                    entry.state = {}
+                    self.logger.info(
+                        'Ignoring %s by configuration.', race_data.get('name'),
+                    )
+
+            if changed:
+                self._scan_interval = self.scan_races_every
+            else:
+                self._scan_interval = min(
+                    self._scan_interval * 1.5,
+                    max(self.scan_races_max, self.scan_races_every),
+                )
+            await asyncio.sleep(self._scan_interval)
+
+    def _handler_done(self, entry):
+        """
+        Clear a race's task once its handler finishes, along with its cached
+        race data, which will be out of date by now.
+        """
+        entry.task = None
+        entry.data = None
+
+    async def _fetch_race_data(self, entry, semaphore):
+        """
+        Retrieve race data for a race from its detail API endpoint.
+
+        If the race summary hasn't changed since the last fetch, the race data
+        we already have is still good and no request is made.
+        """
+        if entry.data is None:
+            async with semaphore:
+                async with self.session.get(
+                    self.http_uri(entry.summary.get('data_url')),
+                ) as resp:
+                    entry.data = await resp.json(loads=orjson.loads, content_type=None)
+        return entry.data
 
     def handle_exception(self, loop, context):
         """
@@ -229,10 +393,29 @@ class Bot:
         """
         Run the bot. Creates an event loop then iterates over it forever.
         """
-        self.loop.create_task(self.reauthorize())
-        self.loop.create_task(self.refresh_races())
-        self.loop.set_exception_handler(self.handle_exception)
-        self.loop.run_forever()
+        try:
+            self.loop.run_until_complete(self.start())
+            self.loop.create_task(self.reauthorize())
+            self.loop.create_task(self.refresh_races())
+            self.loop.set_exception_handler(self.handle_exception)
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.stop())
+
+    async def stop(self):
+        """
+        Shut the bot down cleanly. Cancels every remaining task (including race
+        handlers) and waits for them to finish, then closes the HTTP session.
+        """
+        tasks = [
+            task for task in asyncio.all_tasks(self.loop)
+            if task is not asyncio.current_task()
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.session:
+            await self.session.close()
 
     def http_uri(self, url):
         """
@@ -1,5 +1,116 @@
-import json
-import uuid
+import asyncio
+import inspect
+import logging
+import os
+import threading
+from functools import partial
+
+import orjson
+import websockets
+
+
+_guid_pool = b''
+_guid_offset = 0
+_guid_lock = threading.Lock()
+
+
+def _new_guid():
+    """
+    Generate a random hex GUID for an outgoing chat message.
+
+    Random bytes are read from the OS 4 KiB at a time and handed out 16 bytes
+    per GUID, instead of making a syscall for every message.
+    """
+    global _guid_pool, _guid_offset
+    with _guid_lock:
+        if _guid_offset + 16 > len(_guid_pool):
+            _guid_pool = os.urandom(4096)
+            _guid_offset = 0
+        guid = _guid_pool[_guid_offset:_guid_offset + 16]
+        _guid_offset += 16
+    return guid.hex()
+
+
+def _reset_guid_pool():
+    """
+    Discard the GUID pool in a forked child process, so it doesn't hand out
+    the same GUIDs as its parent. The lock is replaced too, in case it was
+    held by another thread when the process forked.
+    """
+    global _guid_pool, _guid_offset, _guid_lock
+    _guid_pool = b''
+    _guid_offset = 0
+    _guid_lock = threading.Lock()
+
+
+# os.register_at_fork is not available on Windows, which can't fork anyway.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_guid_pool)
+
+
+# orjson.Fragment (orjson 3.10+) embeds already-serialized JSON in a document.
+_Fragment = getattr(orjson, 'Fragment', None)
+
+
+def _frame(action, data=None):
+    """
+    Serialize an action (and its data, if any) into a frame to send to the
+    race room.
+
+    Frames are text, as the race room doesn't accept binary frames.
+    """
+    frame = {'action': action}
+    if data is not None:
+        frame['data'] = data
+    return orjson.dumps(frame).decode()
+
+
+def _message_frame(message, actions=None, pinned=False, direct_to=None):
+    """
+    Build the frame for a chat message. See `RaceHandler.send_message` for
+    what each argument means.
+    """
+    if actions and not isinstance(actions, dict):
+        # Assume actions is a list of Action objects
+        if _Fragment:
+            # Splice in each action's cached JSON as-is.
+            actions = {
+                action.label: _Fragment(action.render())
+                for action in actions
+            }
+        else:
+            actions = {
+                action.label: action.data for action in actions
+            }
+    if direct_to and (actions or pinned):
+        raise Exception('Cannot DM a message with actions or pin')
+    return _frame('message', {
+        'message': message,
+        'direct_to': direct_to,
+        'actions': actions,
+        'pinned': pinned,
+        'guid': _new_guid(),
+    })
+
+
+# Frames for actions that never carry any data, serialized once up front.
+_STATIC_FRAMES = {
+    action: _frame(action)
+    for action in ('make_open', 'make_invitational', 'begin', 'cancel')
+}
+
+
+class RaceLoggerAdapter(logging.LoggerAdapter):
+    """
+    Logger adapter for race handlers.
+
+    Prefixes each message with the name of the race, and adds it to the log
+    record as `race`, so it can also be used in log formats as `%(race)s`.
+    Any `extra` passed to a logging call is kept alongside it.
+    """
+    def process(self, msg, kwargs):
+        kwargs['extra'] = {**self.extra, **(kwargs.get('extra') or {})}
+        return '[%s] %s' % (self.extra['race'], msg), kwargs
 
 
 class RaceHandler:
@@ -12,15 +123,61 @@ class RaceHandler:
     """
     # This is used by `should_stop` to determine when the handler should quit.
     stop_at = ['cancelled', 'finished']
+    # Outgoing frames are queued and sent in batches of up to this many.
+    send_batch_size = 128
+    # Seconds to wait for further outgoing frames before sending a batch.
+    send_max_wait = 0
+    # Reconnect attempts back off exponentially up to this many seconds.
+    reconnect_max_wait = 60
+    # A connection that stays up this many seconds resets the backoff.
+    reconnect_reset_after = 60
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._build_dispatch_tables()
+
+    @classmethod
+    def _build_dispatch_tables(cls):
+        """
+        Map incoming message types and chat commands to the methods that
+        handle them, so `consume` and `chat_message` can find them with a
+        single lookup.
+
+        For example, "race.data" maps to `race_data` and "!seed" maps to
+        `ex_seed`. Message types may themselves contain underscores, so each
+        method is registered both with only its first underscore swapped for
+        a dot ("race.split_update") and with all of them swapped
+        ("race.split.update").
+
+        Also freezes `stop_at` into a set for quick status checks.
+        """
+        cls._stop_at_set = frozenset(cls.stop_at)
+        cls._msg_handlers = {}
+        cls._ex_handlers = {}
+        for name in dir(cls):
+            if name.startswith('_'):
+                continue
+            func = getattr(cls, name)
+            if not callable(func):
+                continue
+            if name.startswith('ex_'):
+                cls._ex_handlers[name[3:]] = func
+            else:
+                cls._msg_handlers[name.replace('_', '.', 1)] = func
+                cls._msg_handlers.setdefault(name.replace('_', '.'), func)
 
     def __init__(self, logger, conn, state, command_prefix='!'):
         """
         Base handler constructor.
 
         Sets up the following attributes:
-        * conn - WebSocket connection, used internally.
+        * conn - WebSocket connection, opened with `async with` (once per
+          reconnect), used internally. A function or coroutine function that
+          returns one is also accepted.
         * data - Race data dict, as retrieved from race detail API endpoint.
-        * logger - The logger instance bot was instantiated with.
+        * logger - A `RaceLoggerAdapter` wrapping the logger instance bot was
+          instantiated with. It adds the "[race name] " prefix to each message
+          automatically, so don't include the race name yourself.
         * state - A dict of stateful data for this race
         * ws - The open WebSocket, used internally.
 
@@ -32,21 +189,44 @@ class RaceHandler:
         want.
         """
         self.conn = conn
+        self.logger = RaceLoggerAdapter(logger, {'race': None})
         self.data = {}
-        self.logger = logger
         self.state = state
         self.command_prefix = command_prefix
+        self._cmd_prefix_lower = command_prefix.lower()
+        self._cmd_prefix_len = len(self._cmd_prefix_lower)
         self.ws = None
+        self._send_queue = None
+        self._flush_task = None
+        self._send_error = None
+        self._last_info = {}
+
+    @property
+    def data(self):
+        """
+        Race data dict, as retrieved from race detail API endpoint.
+        """
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.logger.extra['race'] = data.get('name') if data else None
+        # The race status only changes with the race data, so work out here
+        # whether it means the handler should stop.
+        self._should_stop = bool(data) and (
+            (data.get('status') or {}).get('value') in self._stop_at_set
+        )
 
     async def should_stop(self):
         """
         Determine if the handler should be terminated. This is checked after
-        every receieved message.
+        every received message.
 
         By default, checks if the race state matches one of the values in
         `stop_at`.
         """
-        return self.data.get('status', {}).get('value') in self.stop_at
+        return self._should_stop
 
     async def begin(self):
         """
@@ -67,16 +247,13 @@ class RaceHandler:
         """
         msg_type = data.get('type')
 
-        self.logger.info('[%(race)s] Received %(msg_type)s' % {
-            'race': self.data.get('name'),
-            'msg_type': msg_type,
-        })
+        self.logger.info('Received %s', msg_type)
 
-        method = msg_type.replace('.', '_')
-        if msg_type and hasattr(self, method):
-            await getattr(self, method)(data)
+        handler = self._msg_handlers.get(msg_type)
+        if handler:
+            await handler(self, data)
         else:
-            self.logger.info(f'No handler for {msg_type}, ignoring.')
+            self.logger.info('No handler for %s, ignoring.', msg_type)
 
     async def end(self):
         """
@@ -110,20 +287,22 @@ class RaceHandler:
             self.logger.info('Ignoring bot/system message.')
             return
 
-        words = message.get('message', '').lower().split(' ')
-        if words and words[0].startswith(self.command_prefix.lower()):
-            method = 'ex_' + words[0][len(self.command_prefix):]
-            args = words[1:]
-            if hasattr(self, method):
-                self.logger.info('[%(race)s] Calling handler for %(word)s' % {
-                    'race': self.data.get('name'),
-                    'word': words[0],
-                })
-                try:
-                    await getattr(self, method)(args, message)
-                except Exception as e:
-                    self.logger.error('Command raised exception.', exc_info=True)
+        text = message.get('message', '')
+        prefix_len = self._cmd_prefix_len
+        # Most chat isn't a command, so bail out before splitting anything.
+        if text[:prefix_len].lower() != self._cmd_prefix_lower:
+            return
 
+        command, sep, rest = text.partition(' ')
+        command = command.lower()
+        handler = self._ex_handlers.get(command[prefix_len:])
+        if handler:
+            args = rest.lower().split(' ') if sep else []
+            self.logger.info('Calling handler for %s', command)
+            try:
+                await handler(self, args, message)
+            except Exception as e:
+                self.logger.error('Command raised exception.', exc_info=True)
 
     async def race_data(self, data):
         """
@@ -144,43 +323,41 @@ class RaceHandler:
         `pinned` will pin the message at the top of the chat window.
         `direct_to` will send message as DM to the specified user ID.
 
+        Messages are queued and sent in the background, so an error delivering
+        one is not raised here. If the connection has already closed, the
+        `ConnectionClosed` error is raised instead of queueing the message.
+
         Note: for more info on setting up race actions, see `msg_actions.py`
         """
-        if actions and not isinstance(actions, dict):
-            # Assume actions is a list of Action objects
-            actions = {
-                action.label: action.data for action in actions
-            }
-        if direct_to and (actions or pinned):
-            raise Exception('Cannot DM a message with actions or pin')
-        await self.ws.send(json.dumps({
-            'action': 'message',
-            'data': {
-                'message': message,
-                'direct_to': direct_to,
-                'actions': actions,
-                'pinned': pinned,
-                'guid': str(uuid.uuid4()),
-            }
-        }))
-        self.logger.info('[%(race)s] Message: "%(message)s"' % {
-            'race': self.data.get('name'),
-            'message': message,
-        })
+        await self._send_frame(
+            _message_frame(message, actions, pinned, direct_to)
+        )
+        self.logger.info('Message: "%s"', message)
+
+    async def send_many(self, messages):
+        """
+        Send several plain chat messages to the race room.
+
+        `messages` should be a list of message strings. They are queued in
+        the order given.
+        """
+        for message in messages:
+            await self._send_frame(_message_frame(message))
+            self.logger.info('Message: "%s"', message)
 
     async def set_bot_raceinfo(self, info):
         """
         Set the `info_bot` field on the race room's data.
+
+        Nothing is sent if this value was the last one sent and the race data
+        still shows it.
         """
-        await self.ws.send(json.dumps({
-            'action': 'setinfo',
-            'data': {'info_bot': info}
-        }))
+        if self._info_unchanged('info_bot', info):
+            return
+        await self._send_frame(_frame('setinfo', {'info_bot': info}))
+        self._last_info['info_bot'] = info
 
-        self.logger.info('[%(race)s] Set info: "%(info)s"' % {
-            'race': self.data.get('name'),
-            'info': info,
-        })
+        self.logger.info('Set info: "%s"', info)
 
     async def set_raceinfo(self, info, overwrite=False, prefix=True):
         """
@@ -191,66 +368,62 @@ class RaceHandler:
         `info` should be the information you wish to set. By default, this
         method will prefix your information with the existing info, if needed.
         You can change this to suffix with `prefix=False`, or disable this
-        behaviour entirely with `overwrite=True`.
+        behaviour entirely with `overwrite=True`. Nothing is sent if the
+        resulting info was the last one sent and the race data still shows it.
         """
-        if self.data.get('info_user') and not overwrite:
+        current_info = self.data.get('info_user')
+        if current_info and not overwrite:
             if prefix:
-                info = info + ' | ' + self.data.get('info_user')
+                info = info + ' | ' + current_info
             else:
-                info = self.data.get('info_user') + ' | ' + info
+                info = current_info + ' | ' + info
+        if self._info_unchanged('info_user', info):
+            return
 
-        await self.ws.send(json.dumps({
-            'action': 'setinfo',
-            'data': {'info_user': info}
-        }))
-        self.logger.info('[%(race)s] [Deprecated] Set info: "%(info)s"' % {
-            'race': self.data.get('name'),
-            'info': info,
-        })
+        await self._send_frame(_frame('setinfo', {'info_user': info}))
+        self._last_info['info_user'] = info
+        self.logger.info('[Deprecated] Set info: "%s"', info)
+
+    def _info_unchanged(self, field, info):
+        """
+        Returns True if setting the given info field would be a no-op.
+
+        The race data lags behind what has been sent, so it is only trusted
+        once it agrees with the last value sent for that field.
+        """
+        return (
+            field in self._last_info
+            and info == self._last_info[field]
+            and info == self.data.get(field)
+        )
 
     async def set_open(self):
         """
         Set the room in an open state.
         """
-        await self.ws.send(json.dumps({
-            'action': 'make_open'
-        }))
-        self.logger.info('[%(race)s] Make open' % {
-            'race': self.data.get('name')
-        })
+        await self._send_frame(_STATIC_FRAMES['make_open'])
+        self.logger.info('Make open')
 
     async def set_invitational(self):
         """
         Set the room in an invite-only state.
         """
-        await self.ws.send(json.dumps({
-            'action': 'make_invitational'
-        }))
-        self.logger.info('[%(race)s] Make invitational' % {
-            'race': self.data.get('name')
-        })
+        await self._send_frame(_STATIC_FRAMES['make_invitational'])
+        self.logger.info('Make invitational')
 
     async def force_start(self):
         """
         Forces a start of the race.
         """
-        await self.ws.send(json.dumps({
-            'action': 'begin'
-        }))
-        self.logger.info('[%(race)s] Forced start' % {
-            'race': self.data.get('name')
-        })
+        await self._send_frame(_STATIC_FRAMES['begin'])
+        self.logger.info('Forced start')
 
     async def cancel_race(self):
         """
         Forcibly cancels a race.
         """
-        await self.ws.send(json.dumps({
-            'action': 'cancel'
-        }))
-        self.logger.info('[%(race)s] cancelled' % {
-            'race': self.data.get('name')
-        })
+        await self._send_frame(_STATIC_FRAMES['cancel'])
+        self.logger.info('cancelled')
 
     async def invite_user(self, user):
         """
@@ -258,16 +431,7 @@ class RaceHandler:
 
         `user` should be the hashid of the user.
         """
-        await self.ws.send(json.dumps({
-            'action': 'invite',
-            'data': {
-                'user': user
-            }
-        }))
-        self.logger.info('[%(race)s] invited %(user)s' % {
-            'race': self.data.get('name'),
-            'user': user
-        })
+        await self._send_user_action('invite', user, 'invited')
 
     async def accept_request(self, user):
         """
@@ -275,16 +439,7 @@ class RaceHandler:
 
         `user` should be the hashid of the user.
         """
-        await self.ws.send(json.dumps({
-            'action': 'accept_request',
-            'data': {
-                'user': user
-            }
-        }))
-        self.logger.info('[%(race)s] accept join request %(user)s' % {
-            'race': self.data.get('name'),
-            'user': user
-        })
+        await self._send_user_action('accept_request', user, 'accept join request')
 
     async def force_unready(self, user):
         """
@@ -292,16 +447,7 @@ class RaceHandler:
 
         `user` should be the hashid of the user.
         """
-        await self.ws.send(json.dumps({
-            'action': 'force_unready',
-            'data': {
-                'user': user
-            }
-        }))
-        self.logger.info('[%(race)s] force unready %(user)s' % {
-            'race': self.data.get('name'),
-            'user': user
-        })
+        await self._send_user_action('force_unready', user, 'force unready')
 
     async def remove_entrant(self, user):
         """
@@ -309,16 +455,7 @@ class RaceHandler:
 
         `user` should be the hashid of the user.
         """
-        await self.ws.send(json.dumps({
-            'action': 'remove_entrant',
-            'data': {
-                'user': user
-            }
-        }))
-        self.logger.info('[%(race)s] removed entrant %(user)s' % {
-            'race': self.data.get('name'),
-            'user': user
-        })
+        await self._send_user_action('remove_entrant', user, 'removed entrant')
 
     async def add_monitor(self, user):
         """
@@ -326,16 +463,7 @@ class RaceHandler:
 
         `user` should be the hashid of the user.
         """
-        await self.ws.send(json.dumps({
-            'action': 'add_monitor',
-            'data': {
-                'user': user
-            }
-        }))
-        self.logger.info('[%(race)s] added race monitor %(user)s' % {
-            'race': self.data.get('name'),
-            'user': user
-        })
+        await self._send_user_action('add_monitor', user, 'added race monitor')
 
     async def remove_monitor(self, user):
         """
@@ -343,16 +471,7 @@ class RaceHandler:
 
         `user` should be the hashid of the user.
         """
-        await self.ws.send(json.dumps({
-            'action': 'remove_monitor',
-            'data': {
-                'user': user
-            }
-        }))
-        self.logger.info('[%(race)s] added race monitor %(user)s' % {
-            'race': self.data.get('name'),
-            'user': user
-        })
+        await self._send_user_action('remove_monitor', user, 'removed race monitor')
 
     async def pin_message(self, message):
         """
@@ -360,16 +479,8 @@ class RaceHandler:
 
         `message` should be the hashid of the message.
         """
-        await self.ws.send(json.dumps({
-            'action': 'pin_message',
-            'data': {
-                'message': message,
-            }
-        }))
-        self.logger.info('[%(race)s] pinned chat message %(message)s' % {
-            'race': self.data.get('name'),
-            'message': message
-        })
+        await self._send_frame(_frame('pin_message', {'message': message}))
+        self.logger.info('pinned chat message %s', message)
 
     async def unpin_message(self, message):
         """
@@ -377,33 +488,168 @@ class RaceHandler:
 
         `message` should be the hashid of the message.
         """
-        await self.ws.send(json.dumps({
-            'action': 'unpin_message',
-            'data': {
-                'message': message,
-            }
-        }))
-        self.logger.info('[%(race)s] unpinned chat message %(message)s' % {
-            'race': self.data.get('name'),
-            'message': message
-        })
+        await self._send_frame(_frame('unpin_message', {'message': message}))
+        self.logger.info('unpinned chat message %s', message)
+
+    async def _send_user_action(self, action, user, description):
+        """
+        Send an action that targets a single user, given by hashid, and log
+        it with the given description.
+        """
+        await self._send_frame(_frame(action, {'user': user}))
+        self.logger.info('%s %s', description, user)
 
     async def handle(self):
         """
         Low-level handler for the race room. This will loop over the websocket,
         processing any messages that come in.
-        """
-        self.logger.info('[%(race)s] Handler started' % {
-            'race': self.data.get('name'),
-        })
-        async with self.conn as ws:
-            self.ws = ws
+
+        If the connection drops unexpectedly, it is re-established and `begin`
+        is called again. The first reconnect after a connection that stayed up
+        for `reconnect_reset_after` seconds happens straight away; otherwise
+        attempts back off exponentially, up to `reconnect_max_wait` seconds.
+        """
+        self.logger.info('Handler started')
+        loop = asyncio.get_event_loop()
+        delay = 0
+        while True:
+            opened_at = None
+            try:
+                async with await self._get_connection() as ws:
+                    opened_at = loop.time()
+                    await self._handle_connection(ws)
+            except websockets.ConnectionClosedOK:
+                # Closed normally while sending.
+                return
+            except websockets.ConnectionClosedError as e:
+                reason, error = 'Connection lost', e
+                if (
+                    opened_at is not None
+                    and loop.time() - opened_at >= self.reconnect_reset_after
+                ):
+                    delay = 0
+                    self.logger.info('%s, reconnecting', reason)
+                    continue
+            except (OSError, asyncio.TimeoutError) as e:
+                reason, error = 'Could not connect', e
+            else:
+                return
+            delay = min(max(delay * 2, 1), self.reconnect_max_wait)
+            self.logger.info(
+                '%s, retrying in %s seconds', reason, delay, exc_info=error,
+            )
+            await asyncio.sleep(delay)
+
+    async def _get_connection(self):
+        """
+        Returns the connection to open, calling `conn` first if it is a
+        function rather than a connection.
+        """
+        conn = self.conn
+        if not hasattr(conn, '__aenter__'):
+            conn = conn()
+            if inspect.isawaitable(conn):
+                conn = await conn
+        return conn
+
+    async def _handle_connection(self, ws):
+        """
+        Process messages from an open websocket until the connection is
+        closed or the handler should stop.
+        """
+        self.ws = ws
+        self._send_queue = asyncio.Queue()
+        self._send_error = None
+        self._flush_task = asyncio.ensure_future(self._flush_loop())
+        try:
             if await self.should_stop():
                 return
             await self.begin()
-            async for message in self.ws:
-                data = json.loads(message)
-                await self.consume(data)
-                if await self.should_stop():
+            # Where supported, receive text frames as raw bytes, since orjson
+            # can parse them without decoding to str first.
+            if 'decode' in inspect.signature(ws.recv).parameters:
+                recv = partial(ws.recv, decode=False)
+            else:
+                recv = ws.recv
+            consume = self.consume
+            should_stop = self.should_stop
+            loads = orjson.loads
+            while True:
+                try:
+                    message = await recv()
+                except websockets.ConnectionClosedOK:
+                    break
+                await consume(loads(message))
+                if await should_stop():
                     await self.end()
                     break
+        finally:
+            # Let anything still queued go out before the connection is
+            # closed.
+            self._send_queue.put_nowait(None)
+            try:
+                await self._flush_task
+            finally:
+                self._send_queue = None
+                self._flush_task = None
+
+    async def _send_frame(self, frame):
+        """
+        Queue a frame to be sent to the race room.
+
+        Every outgoing frame goes through here. If the connection has closed,
+        the `ConnectionClosed` error that closed it is raised instead, so the
+        handler reconnects as it would if the send had failed directly.
+        """
+        if self._send_error is not None:
+            raise self._send_error
+        if self._send_queue is None or self._flush_task.done():
+            # Between connections, e.g. while reconnecting.
+            raise websockets.ConnectionClosedError(None, None)
+        self._send_queue.put_nowait(frame)
+
+    async def _flush_loop(self):
+        """
+        Send queued frames down the websocket.
+
+        Frames are collected into batches of up to `send_batch_size`, waiting
+        at most `send_max_wait` seconds after the first frame for more to
+        arrive. Queueing None stops the loop once everything before it has
+        been sent. If the connection closes, the loop stops, any frames still
+        waiting are dropped, and the error is kept for `_send_frame` to raise.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._send_queue.get()]
+            deadline = loop.time() + self.send_max_wait
+            while batch[-1] is not None and len(batch) < self.send_batch_size:
+                try:
+                    batch.append(self._send_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(
+                            self._send_queue.get(), timeout,
+                        ))
+                    except asyncio.TimeoutError:
+                        break
+            for i, frame in enumerate(batch):
+                if frame is None:
+                    return
+                try:
+                    await self.ws.send(frame)
+                except websockets.ConnectionClosed as e:
+                    self._send_error = e
+                    unsent = batch[i:]
+                    while not self._send_queue.empty():
+                        unsent.append(self._send_queue.get_nowait())
+                    unsent = sum(1 for frame in unsent if frame is not None)
+                    self.logger.info(
+                        'Connection closed, dropped %s unsent frame(s)', unsent,
+                    )
+                    return
+
+
+RaceHandler._build_dispatch_tables()
@@ -8,8 +8,35 @@ commands.
 Actions can optionally include a Survey, which allows you to customise what
 message is sent by first giving the user a small form to fill in. The answers
 will then be interpolated into the action message.
+
+Each object's JSON is rendered once and reused for every message it's sent
+with, so avoid changing its `data` after it has been sent.
 """
-class Action:
+import orjson
+
+
+class Renderable:
+    """
+    Base for objects that are sent to the site as JSON.
+
+    The JSON form of `data` is generated on first use and cached.
+    """
+    __slots__ = ('data', '_json')
+
+    def __init__(self, data):
+        self.data = data
+        self._json = None
+
+    def render(self):
+        """
+        Return `data` serialized as JSON bytes.
+        """
+        if self._json is None:
+            self._json = orjson.dumps(self.data)
+        return self._json
+
+
+class Action(Renderable):
     """
     An action button.
 
@@ -20,11 +47,13 @@ class Action:
     `survey` (optional) - should be a Survey instance
     `help_text` (optional) - title text that appears when user hovers on the button
     """
+    __slots__ = ('label',)
+
     def __init__(self, label, message, submit=None, survey=None, help_text=None):
-        self.label = label
-        self.data = {
+        super().__init__({
             'message': message,
-        }
+        })
+        self.label = label
         if submit:
             self.data['submit'] = submit
         if survey:
@@ -32,7 +61,7 @@ class Action:
         if help_text:
             self.data['help'] = help_text
 
-class ActionLink:
+class ActionLink(Renderable):
     """
     An action link.
 
@@ -42,26 +71,30 @@ class ActionLink:
 
     Note that link actions cannot use surveys.
     """
+    __slots__ = ('label',)
+
     def __init__(self, label, url, help_text=None):
-        self.label = label
-        self.data = {
+        super().__init__({
             'url': url,
-        }
+        })
+        self.label = label
         if help_text:
             self.data['help'] = help_text
 
 
-class Survey:
+class Survey(Renderable):
     """
     `questions` should be Question instances
     """
+    __slots__ = ()
+
     def __init__(self, *questions):
-        self.data = [
+        super().__init__([
             question.data for question in questions
-        ]
+        ])
 
 
-class Question:
+class Question(Renderable):
     """
     Abstract Question class. Use one of the Input classes for actual surveys.
 
@@ -71,13 +104,21 @@ class Question:
     `label` (required) - friendly name of the field the user sees
     `default` (optional) - Default value for the field
     `help_text` (optional) - Extra text that appears below the field
+
+    Subclasses also pass in their `question_type`, plus a dict of any `extra`
+    fields that type of question needs.
     """
-    def __init__(self, name, label, help_text=None, default=None, **kwargs):
-        self.data = {
+    __slots__ = ()
+
+    def __init__(self, name, label, help_text=None, default=None,
+                 question_type=None, extra=None):
+        super().__init__({
             'name': name,
             'label': label,
-            **kwargs,
-        }
+            'type': question_type,
+        })
+        if extra:
+            self.data.update(extra)
         if default:
             self.data['default'] = default
         if help_text:
@@ -92,9 +133,14 @@ class TextInput(Question):
 
     `placeholder` (optional) - Placeholder text for the field
     """
+    __slots__ = ()
+
     def __init__(self, name, label, placeholder=None,
                  help_text=None, default=None):
-        super().__init__(name, label, help_text, default, type='input', placeholder=placeholder)
+        super().__init__(
+            name, label, help_text, default, question_type='input',
+            extra={'placeholder': placeholder} if placeholder else None,
+        )
 
 
 class BoolInput(Question):
@@ -105,8 +151,10 @@ class BoolInput(Question):
 
     Note that `default`.
     """
+    __slots__ = ()
+
     def __init__(self, name, label, help_text=None, default=None):
-        super().__init__(name, label, help_text, default, type='bool')
+        super().__init__(name, label, help_text, default, question_type='bool')
 
 
 class RadioInput(Question):
@@ -119,9 +167,14 @@ class RadioInput(Question):
 
     Note that if `default` is used, its value should match a value from `options`, not a label.
     """
+    __slots__ = ()
+
     def __init__(self, name, label, options,
                  help_text=None, default=None):
-        super().__init__(name, label, help_text, default, options=options, type='radio')
+        super().__init__(
+            name, label, help_text, default, question_type='radio',
+            extra={'options': options},
+        )
 
 
 class SelectInput(Question):
@@ -134,6 +187,11 @@ class SelectInput(Question):
 
     Note that if `default` is used, its value should match a value from `options`, not a label.
     """
+    __slots__ = ()
+
     def __init__(self, name, label, options,
                  help_text=None, default=None):
-        super().__init__(name, label, help_text, default, options=options, type='select')
+        super().__init__(
+            name, label, help_text, default, question_type='select',
+            extra={'options': options},
+        )
@@ -21,8 +21,13 @@ setup(
     install_requires=[
         'aiohttp',
         'asgiref',
-        'requests',
-        'websockets',
+        'orjson>=3.0',
+        'websockets>=10.0',
     ],
+    extras_require={
+        'fast': [
+            'uvloop; sys_platform != "win32"',
+        ],
+    },
     packages=find_packages(),
 )